@@ -1,12 +1,19 @@
 from fastapi import FastAPI, Request, Depends, Form
-from fastapi.responses import RedirectResponse
+from fastapi.responses import HTMLResponse, ORJSONResponse, RedirectResponse, Response
 from fastapi.templating import Jinja2Templates
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime
-from sqlalchemy.orm import sessionmaker, declarative_base, Session
+from jinja2 import FileSystemBytecodeCache
+from sqlalchemy import event, bindparam, select, delete, or_, Column, Integer, String, Float, DateTime
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.orm import declarative_base, load_only
 import aiohttp
 import asyncio
 import csv
+import hashlib
+import time
 from datetime import datetime, timedelta
+from itertools import islice
 
 
 Base = declarative_base()
@@ -20,7 +27,7 @@ class City(Base):
     latitude = Column(Float)
     longitude = Column(Float)
     temperature = Column(Float, nullable=True)
-    updated_at = Column(DateTime, nullable=True)
+    updated_at = Column(DateTime, nullable=True, index=True)
 
 
 class DefaultCity(Base):
@@ -32,147 +39,258 @@ class DefaultCity(Base):
     longitude = Column(Float)
 
 
-DATABASE_URL = "sqlite:///./cities.db"
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-Base.metadata.create_all(bind=engine)
+DEFAULT_CITY_INSERT = DefaultCity.__table__.insert()
+CITY_INSERT = City.__table__.insert()
+SEED_BATCH_SIZE = 500
 
+SELECT_CITIES_BY_TEMPERATURE = select(City).options(
+    load_only(City.id, City.name, City.temperature, City.updated_at)
+).order_by(City.temperature.desc().nullslast())
+SELECT_STALE_CITIES = select(City.id, City.latitude, City.longitude).where(
+    or_(City.updated_at.is_(None), City.updated_at <= bindparam("cutoff"))
+)
+UPDATE_CITY_WEATHER = City.__table__.update().where(City.__table__.c.id == bindparam("i")).values(
+    temperature=bindparam("t"), updated_at=bindparam("u")
+)
+DELETE_CITY_BY_ID = delete(City).where(City.id == bindparam("cid"))
+INSERT_CITY_IF_MISSING = sqlite_insert(City.__table__).on_conflict_do_nothing(index_elements=["name"])
 
-app = FastAPI(title="Weather App")
+
+DATABASE_URL = "sqlite+aiosqlite:///./cities.db"
+engine = create_async_engine(
+    DATABASE_URL,
+    poolclass=AsyncAdaptedQueuePool,
+    pool_size=10,
+    max_overflow=20,
+    pool_pre_ping=True,
+    pool_recycle=3600,
+    pool_use_lifo=True
+)
+
+
+@event.listens_for(engine.sync_engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA cache_size=-64000")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.close()
+
+
+AsyncSessionLocal = async_sessionmaker(autoflush=False, expire_on_commit=False, bind=engine)
+
+
+app = FastAPI(title="Weather App", default_response_class=ORJSONResponse)
 templates = Jinja2Templates(directory="templates")
+templates.env.auto_reload = False
+templates.env.bytecode_cache = FileSystemBytecodeCache()
+
+UPDATE_INTERVAL = timedelta(minutes=15)
+WEATHER_TIMEOUT = aiohttp.ClientTimeout(total=5, connect=2)
+WEATHER_ATTEMPTS = 2
+WEATHER_BATCH_SIZE = 100
+WEATHER_CONCURRENCY = 10
+
+PAGE_CACHE_TTL = 60
+_page_cache = {"etag": None, "html": None, "expires": 0, "generation": 0}
 
 
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
-async def fetch_weather(session: aiohttp.ClientSession, latitude: float, longitude: float):
-    url = f"https://api.open-meteo.com/v1/forecast?latitude={latitude}&longitude={longitude}&current_weather=true"
-    try:
-        async with session.get(url) as response:
-            if response.status == 200:
-                data = await response.json()
-                return data.get("current_weather", {}).get("temperature")
-    except Exception as e:
-        print(f"Error fetching weather for ({latitude}, {longitude}): {e}")
-    return None
+def invalidate_page_cache():
+    _page_cache["expires"] = 0
+    _page_cache["generation"] += 1
+
+
+def create_missing_indexes(connection):
+    # create_all skips tables that already exist, so indexes added to City later are created here
+    for index in City.__table__.indexes:
+        index.create(connection, checkfirst=True)
+
+
+async def copy_default_cities(db: AsyncSession):
+    default_cities = (await db.execute(select(DefaultCity))).scalars().all()
+    if default_cities:
+        await db.execute(CITY_INSERT, [
+            {
+                "name": dc.name,
+                "latitude": dc.latitude,
+                "longitude": dc.longitude,
+                "temperature": None,
+                "updated_at": None
+            }
+            for dc in default_cities
+        ])
+
+
+async def fetch_weather_batch(session: aiohttp.ClientSession, semaphore: asyncio.Semaphore, cities: list) -> list:
+    latitudes = ",".join(str(city.latitude) for city in cities)
+    longitudes = ",".join(str(city.longitude) for city in cities)
+    url = f"https://api.open-meteo.com/v1/forecast?latitude={latitudes}&longitude={longitudes}&current_weather=true"
+    async with semaphore:
+        for attempt in range(WEATHER_ATTEMPTS):
+            try:
+                async with session.get(url, timeout=WEATHER_TIMEOUT) as response:
+                    if response.status != 200:
+                        print(f"Weather API returned {response.status} for {len(cities)} cities")
+                        break
+                    data = await response.json()
+                    # Open-Meteo returns a single object for one location and a list for several
+                    if isinstance(data, dict):
+                        data = [data]
+                    if len(data) != len(cities):
+                        print(f"Weather API returned {len(data)} results for {len(cities)} cities")
+                        break
+                    return [item.get("current_weather", {}).get("temperature") for item in data]
+            except (asyncio.TimeoutError, aiohttp.ClientError, ValueError) as e:
+                print(f"Error fetching weather for {len(cities)} cities (attempt {attempt + 1}): {e}")
+    return [None] * len(cities)
 
 
 async def fetch_all_weather(cities: list) -> list:
-    async with aiohttp.ClientSession() as session:
-        tasks = [
-            fetch_weather(session, city.latitude, city.longitude)
-            for city in cities
-        ]
-        return await asyncio.gather(*tasks)
+    session = app.state.http_session
+    semaphore = app.state.weather_semaphore
+    batches = [
+        cities[i:i + WEATHER_BATCH_SIZE]
+        for i in range(0, len(cities), WEATHER_BATCH_SIZE)
+    ]
+    results = await asyncio.gather(*(fetch_weather_batch(session, semaphore, batch) for batch in batches))
+    return [temp for result in results for temp in result]
 
 
+@app.on_event("startup")
+async def open_http_session():
+
+    app.state.http_session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=100,
+            limit_per_host=WEATHER_CONCURRENCY,
+            ttl_dns_cache=300,
+            keepalive_timeout=60
+        )
+    )
+    app.state.weather_semaphore = asyncio.Semaphore(WEATHER_CONCURRENCY)
+
+
+@app.on_event("shutdown")
+async def close_http_session():
+
+    await app.state.http_session.close()
+
 
 @app.on_event("startup")
-def startup_event():
+async def startup_event():
+
+    templates.env.get_template("index.html")
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(create_missing_indexes)
 
-    db = SessionLocal()
-    try:
+    async with AsyncSessionLocal() as db:
 
-        if not db.query(DefaultCity).first():
+        if not (await db.execute(select(DefaultCity.id).limit(1))).first():
             try:
                 with open("cities.csv", "r", encoding="utf-8") as f:
-                    reader = csv.DictReader(f)
-                    for row in reader:
-                        db.add(DefaultCity(
-                            name=row["city"],
-                            latitude=float(row["latitude"]),
-                            longitude=float(row["longitude"])
-                        ))
-                db.commit()
+                    reader = csv.reader(f)
+                    header = next(reader)
+                    name_idx = header.index("city")
+                    lat_idx = header.index("latitude")
+                    lon_idx = header.index("longitude")
+                    rows = (
+                        {"name": row[name_idx], "latitude": float(row[lat_idx]), "longitude": float(row[lon_idx])}
+                        for row in reader
+                        if row
+                    )
+                    while batch := list(islice(rows, SEED_BATCH_SIZE)):
+                        await db.execute(DEFAULT_CITY_INSERT, batch)
+                await db.commit()
                 print("Default cities loaded from CSV")
             except FileNotFoundError:
                 print("Warning: cities.csv not found")
 
-        if not db.query(City).first():
-            default_cities = db.query(DefaultCity).all()
-            for dc in default_cities:
-                db.add(City(
-                    name=dc.name,
-                    latitude=dc.latitude,
-                    longitude=dc.longitude,
-                    temperature=None,
-                    updated_at=None
-                ))
-            db.commit()
+        if not (await db.execute(select(City.id).limit(1))).first():
+            await copy_default_cities(db)
+            await db.commit()
             print("Cities table initialized from defaults")
-    finally:
-        db.close()
 
 
 
 @app.get("/")
-async def read_root(request: Request, db: Session = Depends(get_db)):
-
-    cities = db.query(City).order_by(
-        City.temperature.desc().nullslast()
-    ).all()
-    return templates.TemplateResponse(
-        "index.html",
-        {"request": request, "cities": cities}
-    )
+async def read_root(request: Request, db: AsyncSession = Depends(get_db)):
+
+    wants_json = "application/json" in request.headers.get("accept", "")
+    html, etag = _page_cache["html"], _page_cache["etag"]
+    if wants_json or time.monotonic() >= _page_cache["expires"]:
+        generation = _page_cache["generation"]
+        cities = (await db.execute(SELECT_CITIES_BY_TEMPERATURE)).scalars().all()
+        if wants_json:
+            return ORJSONResponse([
+                {"id": c.id, "name": c.name, "temperature": c.temperature, "updated_at": c.updated_at}
+                for c in cities
+            ], headers={"Vary": "Accept"})
+        html = templates.get_template("index.html").render(request=request, cities=cities)
+        etag = '"' + hashlib.md5(html.encode()).hexdigest() + '"'
+        # a mutation committed while the query was awaited: serve this render but don't cache it
+        if generation == _page_cache["generation"]:
+            _page_cache["html"] = html
+            _page_cache["etag"] = etag
+            _page_cache["expires"] = time.monotonic() + PAGE_CACHE_TTL
+
+    # no-cache: browsers must revalidate, otherwise the page shown after a POST redirect could be stale
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return HTMLResponse(html, headers=headers)
 
 
 @app.post("/cities/remove/{city_id}")
-async def remove_city(city_id: int, db: Session = Depends(get_db)):
+async def remove_city(city_id: int, db: AsyncSession = Depends(get_db)):
 
-    city = db.query(City).filter(City.id == city_id).first()
-    if city:
-        db.delete(city)
-        db.commit()
+    async with db.begin():
+        result = await db.execute(DELETE_CITY_BY_ID, {"cid": city_id})
+    if result.rowcount:
+        invalidate_page_cache()
     return RedirectResponse("/", status_code=303)
 
 
 @app.post("/cities/reset")
-async def reset_cities(db: Session = Depends(get_db)):
-
-    db.query(City).delete()
-
-    default_cities = db.query(DefaultCity).all()
-    for dc in default_cities:
-        db.add(City(
-            name=dc.name,
-            latitude=dc.latitude,
-            longitude=dc.longitude,
-            temperature=None,
-            updated_at=None
-        ))
-    db.commit()
+async def reset_cities(db: AsyncSession = Depends(get_db)):
+
+    async with db.begin():
+        await db.execute(delete(City))
+        await copy_default_cities(db)
+    invalidate_page_cache()
     return RedirectResponse("/", status_code=303)
 
 
 @app.post("/cities/update")
-async def update_weather(db: Session = Depends(get_db)):
+async def update_weather(db: AsyncSession = Depends(get_db)):
 
-    cities = db.query(City).all()
     now = datetime.utcnow()
-
-
-    cities_to_update = []
-    for city in cities:
-        if city.updated_at is None or (now - city.updated_at) >= timedelta(minutes=15):
-            cities_to_update.append(city)
+    cutoff = now - UPDATE_INTERVAL
+    async with db.begin():
+        cities_to_update = (await db.execute(SELECT_STALE_CITIES, {"cutoff": cutoff})).all()
 
     if cities_to_update:
 
         temperatures = await fetch_all_weather(cities_to_update)
 
-
-        for city, temp in zip(cities_to_update, temperatures):
-            if temp is not None:
-                city.temperature = temp
-                city.updated_at = now
-
-        db.commit()
+        params = [
+            {"i": city.id, "t": temp, "u": now}
+            for city, temp in zip(cities_to_update, temperatures)
+            if temp is not None
+        ]
+        if params:
+            # written in its own transaction so nothing is held open during the HTTP fetch
+            async with db.begin():
+                await db.execute(UPDATE_CITY_WEATHER, params)
+            invalidate_page_cache()
 
     return RedirectResponse("/", status_code=303)
 
@@ -183,19 +301,14 @@ async def add_city(
     name: str = Form(...),
     latitude: float = Form(...),
     longitude: float = Form(...),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
 
-    existing = db.query(City).filter(City.name == name).first()
-    if not existing:
-        city = City(
-            name=name,
-            latitude=latitude,
-            longitude=longitude,
-            temperature=None,
-            updated_at=None
+    async with db.begin():
+        result = await db.execute(
+            INSERT_CITY_IF_MISSING,
+            {"name": name, "latitude": latitude, "longitude": longitude}
         )
-        db.add(city)
-        db.commit()
+    if result.rowcount:
+        invalidate_page_cache()
     return RedirectResponse("/", status_code=303)
-